@@ -2,46 +2,110 @@
 Custom Dataset for Training
 """
 #!/usr/bin/env python
+from pathlib import Path
 import glob
 import os
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import (BatchSampler, DataLoader, Dataset,
+                              RandomSampler, SequentialSampler, get_worker_info)
 import numpy as np
 import torch
 
+
 def fetch_loaders(processed_dir, batch_size=32,
                   train_folder='train', dev_folder='dev', test_folder='',
-                  shuffle=True):
+                  shuffle=True, prefetch_factor=4):
     """ Function to fetch dataLoaders for the Training / Validation
 
     Args:
         processed_dir(str): Directory with the processed data
         batch_size(int): The size of each batch during training. Defaults to 32.
+        prefetch_factor(int): Number of batches loaded in advance by each worker.
 
     Return:
         Returns train and val dataloaders
 
     """
+    # whole batches are fetched by the dataset, see GlacierDataset.__getitem__
+    def make_loader(dataset, num_workers, shuffle):
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        worker_opts = {}
+        if num_workers > 0:
+            worker_opts = {
+                "persistent_workers": True,
+                "prefetch_factor": prefetch_factor
+            }
+
+        return DataLoader(dataset, batch_size=None,
+                          sampler=BatchSampler(sampler, batch_size, drop_last=False),
+                          num_workers=num_workers,
+                          pin_memory=torch.cuda.is_available(),
+                          **worker_opts)
+
     train_dataset = GlacierDataset(processed_dir / train_folder)
     val_dataset = GlacierDataset(processed_dir / dev_folder)
     loader = {
-        "train": DataLoader(train_dataset, batch_size=batch_size,
-                            num_workers=8, shuffle=shuffle),
-        "val": DataLoader(val_dataset, batch_size=batch_size,
-                          num_workers=3, shuffle=False)}
+        "train": make_loader(train_dataset, 8, shuffle),
+        "val": make_loader(val_dataset, 3, False)}
 
     if test_folder:
         test_dataset = GlacierDataset(processed_dir / test_folder)
-        loader["test"] = DataLoader(test_dataset, batch_size=batch_size,
-                                    num_workers=3, shuffle=False)
+        loader["test"] = make_loader(test_dataset, 3, False)
 
     return loader
 
 
+def write_shards(folder_path, dtype=np.float16):
+    """ Pack the img / mask pairs of a split folder into two memory-mappable arrays
+
+    The shards are written as shard_x.npy and shard_y.npy inside folder_path,
+    stacked in the same (sorted) order used by GlacierDataset. They are built
+    under temporary names and only moved into place once complete.
+    GlacierDataset ignores shards that no longer match the slices.
+
+    Args:
+        folder_path(str): A path to a split directory (e.g., train/)
+        dtype(np.dtype): The storage type of the shards. Defaults to float16.
+
+    Return:
+        Paths to the image and mask shards, or (None, None) if the folder has
+        no slices (e.g., an empty split)
+    """
+    img_files = sorted(glob.glob(os.path.join(folder_path, '*img*')))
+    mask_files = [s.replace("img", "mask") for s in img_files]
+    if not img_files:
+        return None, None
+
+    x_path = Path(folder_path, "shard_x.npy")
+    y_path = Path(folder_path, "shard_y.npy")
+
+    tmp_paths = {"x": Path(f"{x_path}.tmp"), "y": Path(f"{y_path}.tmp")}
+
+    shards = {}
+    for i, (img_path, mask_path) in enumerate(zip(img_files, mask_files)):
+        for k, path in [("x", img_path), ("y", mask_path)]:
+            data = np.load(path)
+            if k not in shards:
+                shards[k] = np.lib.format.open_memmap(
+                    tmp_paths[k], mode="w+", dtype=dtype,
+                    shape=(len(img_files),) + data.shape
+                )
+            shards[k][i] = data
+
+    for shard in shards.values():
+        shard.flush()
+    del shards
+
+    os.replace(tmp_paths["x"], x_path)
+    os.replace(tmp_paths["y"], y_path)
+    return x_path, y_path
+
+
 class GlacierDataset(Dataset):
     """Custom Dataset for Glacier Data
 
     Indexing the i^th element returns the underlying image and the associated
-    binary mask
+    binary mask. If the folder contains shards from write_shards, samples are
+    sliced from the memory-mapped shards instead of opening one file each.
 
     """
 
@@ -53,26 +117,86 @@ class GlacierDataset(Dataset):
 
         """
 
-        self.img_files = glob.glob(os.path.join(folder_path, '*img*'))
+        self.img_files = sorted(glob.glob(os.path.join(folder_path, '*img*')))
         self.mask_files = [s.replace("img", "mask") for s in self.img_files]
 
+        self.x, self.y = None, None
+        x_path = Path(folder_path, "shard_x.npy")
+        y_path = Path(folder_path, "shard_y.npy")
+        if x_path.exists() and y_path.exists():
+            x = np.load(x_path, mmap_mode="r")
+            y = np.load(y_path, mmap_mode="r")
+            if self._shards_match(x, y, min(x_path.stat().st_mtime, y_path.stat().st_mtime)):
+                self.x, self.y = x, y
+            else:
+                print(f"shards in {folder_path} are out of date, reading slices instead")
+
+    def _shards_match(self, x, y, shard_mtime):
+        """Check that shards cover the current slices, and are newer than them"""
+        if not self.img_files or len(x) != len(self.img_files) or len(y) != len(self.mask_files):
+            return False
+
+        if x.shape[1:] != np.load(self.img_files[0], mmap_mode="r").shape or \
+           y.shape[1:] != np.load(self.mask_files[0], mmap_mode="r").shape:
+            return False
+
+        slice_mtime = max(os.path.getmtime(f) for f in self.img_files + self.mask_files)
+        return slice_mtime <= shard_mtime
+
     def __getitem__(self, index):
 
         """ getitem method to retrieve a single instance of the dataset
 
+        A list of indices returns the whole batch at once. Inside a DataLoader
+        worker, the batch is written straight into shared memory, so only a
+        handle is sent back to the main process.
+
         Args:
-            index(int): Index identifier of the data instance
+            index(int or list): Index identifier(s) of the data instance(s)
 
         Return:
             data(x) and corresponding label(y)
         """
+        if isinstance(index, (list, tuple)):
+            return self._get_batch(index)
+
+        # converting straight from the mapped pages makes the only copy
+        data, label = self._arrays(index)
+        data = np.array(data, dtype=np.float32)
+        label = np.array(label, dtype=np.float32)
+        return torch.from_numpy(data), torch.from_numpy(label)
 
-        img_path = self.img_files[index]
-        mask_path = self.mask_files[index]
-        data = np.load(img_path)
-        label = np.load(mask_path)
+    def _arrays(self, index):
+        """Memory-mapped image and mask arrays for a single index"""
+        if self.x is not None:
+            return self.x[index], self.y[index]
 
-        return torch.from_numpy(data).float(), torch.from_numpy(label).float()
+        data = np.load(self.img_files[index], mmap_mode="r")
+        label = np.load(self.mask_files[index], mmap_mode="r")
+        return data, label
+
+    def _get_batch(self, indices):
+        """Fill preallocated batch tensors sample by sample"""
+        data, label = self._arrays(indices[0])
+        x = self._empty_batch((len(indices),) + data.shape)
+        y = self._empty_batch((len(indices),) + label.shape)
+
+        x_np, y_np = x.numpy(), y.numpy()
+        x_np[0], y_np[0] = data, label
+        for k, index in enumerate(indices[1:], 1):
+            x_np[k], y_np[k] = self._arrays(index)
+
+        return x, y
+
+    @staticmethod
+    def _empty_batch(shape):
+        """Uninitialized float tensor, allocated in shared memory in workers"""
+        if get_worker_info() is None:
+            return torch.empty(shape)
+
+        # as in default_collate, avoids copying the batch into shared memory
+        storage = torch.FloatStorage._new_shared(int(np.prod(shape)))
+        return torch.empty(0).new(storage).view(shape)
 
     def __len__(self):
         """ Function to return the length of the dataset
@@ -82,4 +206,53 @@ class GlacierDataset(Dataset):
                 len(img_files)(int): The length of the dataset (img_files)
 
         """
+        if self.x is not None:
+            return len(self.x)
         return len(self.img_files)
+
+
+class CUDAPrefetcher:
+    """Wrap a DataLoader to copy batches to the GPU ahead of time
+
+    While the model works on batch i, batch i + 1 is copied to the device on a
+    separate CUDA stream. Best used with a loader that has pin_memory=True.
+
+    """
+
+    def __init__(self, loader, device):
+        """Initialize prefetcher.
+
+        Args:
+            loader(DataLoader): Loader yielding (x, y) pairs of CPU tensors
+            device(torch.device): CUDA device to copy the batches to
+
+        """
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = iter(self.loader)
+        batch = self._preload(batches)
+        while batch is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(self.stream)
+            for t in batch:
+                t.record_stream(current)
+
+            next_batch = self._preload(batches)
+            yield batch
+            batch = next_batch
+
+    def _preload(self, batches):
+        """Start copying the next batch on the side stream"""
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return None
+
+        with torch.cuda.stream(self.stream):
+            return tuple(t.to(self.device, non_blocking=True) for t in batch)
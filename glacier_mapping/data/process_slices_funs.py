@@ -2,8 +2,11 @@
 """
 Functions to support slice processing
 """
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from shutil import copyfile
+import errno
+import functools
 import json
 import os
 import random
@@ -25,13 +28,13 @@ def filter_directory(slice_meta, filter_perc=[0.2], filter_channel=[1]):
         img and mask
 
     """
+    keep = (slice_meta["img_mean"] > 0).to_numpy()
     for i, channel in enumerate(filter_channel):
-        slice_meta = slice_meta[slice_meta[f"mask_mean_{channel}"] > filter_perc[i]]
-    slice_meta = slice_meta[slice_meta["img_mean"] > 0]
-    return [
-        {"img": d["img_slice"], "mask": d["mask_slice"]}
-        for _, d in slice_meta.iterrows()
-    ]
+        keep = keep & (slice_meta[f"mask_mean_{channel}"] > filter_perc[i]).to_numpy()
+
+    imgs = slice_meta["img_slice"].to_numpy()[keep]
+    masks = slice_meta["mask_slice"].to_numpy()[keep]
+    return [{"img": img, "mask": mask} for img, mask in zip(imgs, masks)]
 
 
 def random_split(ids, split_ratio, seed=0,**kwargs):
@@ -42,17 +45,17 @@ def random_split(ids, split_ratio, seed=0,**kwargs):
           "mask" giving paths to data that need to be split into train / dev /
           test.
         split_ratio: Ratio of split among train:dev:test
+        seed(int): Seed for the permutation, for reproducible splits
 
     Return:
         Train/Test/Dev splits
     """
-    random.Random(seed).shuffle(ids)
-    sizes = len(ids) * np.array(split_ratio)
-    ix = [int(s) for s in np.cumsum(sizes)]
+    perm = np.random.default_rng(seed).permutation(len(ids))
+    ix = np.cumsum(len(ids) * np.array(split_ratio)).astype(int)
     return {
-        "train": ids[: ix[0]],
-        "dev": ids[ix[0] : ix[1]],
-        "test": ids[ix[1] : ix[2]],
+        "train": [ids[i] for i in perm[: ix[0]]],
+        "dev": [ids[i] for i in perm[ix[0] : ix[1]]],
+        "test": [ids[i] for i in perm[ix[1] : ix[2]]],
     }
 
 
@@ -61,20 +64,19 @@ def geographic_split(ids, geojsons, slice_meta, dev_ratio=0.10, crs=3857, **kwar
     """
     splits = {"train": [], "dev": [], "test": []}
 
+    # project all slice geometries once, and look them up by slice id
+    slice_geos = slice_meta.geometry.to_crs(crs).buffer(0)
+    slice_geos = dict(zip(slice_meta.img_slice.to_numpy(), slice_geos.to_numpy()))
+
     for k, path in geojsons.items():
         split_geo = gpd.read_file(path)
-        split_geo = split_geo.to_crs(crs).buffer(0)
-
-        i = 1
-        for slice_id in ids:
-            print(f"determing split for slice {i}/{len(ids)}")
-            i += 1
+        split_geo = split_geo.to_crs(crs).buffer(0).iloc[0]
 
-            # get the row of the pandas with the current slice id
-            slice_geo = slice_meta[slice_meta.img_slice == slice_id["img"]]["geometry"]
-            slice_geo = slice_geo.to_crs(crs).reset_index().buffer(0)
+        for i, slice_id in enumerate(ids, 1):
+            if i % 500 == 0 or i == len(ids):
+                print(f"determing split for slice {i}/{len(ids)}")
 
-            if split_geo.contains(slice_geo)[0]:
+            if split_geo.contains(slice_geos[slice_id["img"]]):
                 if k == "train":
                     if random.random() < dev_ratio:
                         splits["dev"].append(slice_id)
@@ -86,14 +88,34 @@ def geographic_split(ids, geojsons, slice_meta, dev_ratio=0.10, crs=3857, **kwar
     return splits
 
 
-def reshuffle(split_ids, output_dir="output/"):
+def _link_one(pair):
+    """Hardlink source to target, copying when they are on different filesystems"""
+    source, target = pair
+    if os.path.exists(target):
+        # target already is the source, removing it would lose the slice
+        if os.path.samefile(source, target):
+            return
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copyfile(source, target)
+
+
+def reshuffle(split_ids, output_dir="output/", n_cpu=None):
     """ Reshuffle Data for Training,
     given a dictionary specifying train / dev / test split,
-    copy into train / dev / test folders.
+    link into train / dev / test folders.
+
+    Targets are hardlinks to the sources whenever possible, so they should be
+    replaced (e.g., removed before np.save) rather than written in place.
 
     Args:
         split_ids(int): IDs of files to split
         output_dir(str): Directory to place the split dataset
+        n_cpu(int): Number of processes used to link the files
     Return:
         Target locations
     """
@@ -101,40 +123,58 @@ def reshuffle(split_ids, output_dir="output/"):
         path = Path(output_dir, split_type)
         os.makedirs(path, exist_ok=True)
 
+    pairs = []
     target_locs = {k: [] for k in split_ids}
     for split_type in split_ids:
-        for i in range(len(split_ids[split_type])):
+        for ids in split_ids[split_type]:
             cur_locs = {}
             for im_type in ["img", "mask"]:
-                print(f"shuffling image {i} - {im_type}")
-                source = split_ids[split_type][i][im_type]
+                source = ids[im_type]
                 target = Path(
                     output_dir, split_type, os.path.basename(source)
                 ).resolve()
-                copyfile(source, target)
+                pairs.append((source, target))
                 cur_locs[im_type] = target
 
             target_locs[split_type].append(cur_locs)
+
+    with ProcessPoolExecutor(n_cpu) as executor:
+        list(executor.map(_link_one, pairs, chunksize=64))
+
     return target_locs
 
 
-def generate_stats(image_paths, sample_size, outpath="stats.json"):
+def _tile_sums(image_path):
+    """Per-channel count, sum and sum of squares of the non-NaN pixels"""
+    x = np.load(image_path)
+    x = x.reshape(-1, x.shape[-1]).astype(np.float64)
+    valid = ~np.isnan(x)
+    x[~valid] = 0
+    return valid.sum(axis=0), x.sum(axis=0), (x * x).sum(axis=0)
+
+
+def generate_stats(image_paths, sample_size, outpath="stats.json", n_workers=4):
     """ Function to generate statistics of the input image channels
 
     Args:
         image_paths: List of Paths to images in directory
         sample_size(int): integer giving the size of the sample from which to compute the statistics
         outpath(str): The path to the output json file containing computed statistics
+        n_workers(int): Number of threads used to load the sampled images
 
     Return:
          Dictionary with keys for means and stds across the channels in input images
     """
     sample_size = min(sample_size, len(image_paths))
     image_paths = np.random.choice(image_paths, sample_size, replace=False)
-    images = [np.load(image_path) for image_path in image_paths]
-    batch = np.stack(images)
-    means = np.nanmean(batch, axis=(0, 1, 2))
-    stds = np.nanstd(batch, axis=(0, 1, 2))
+
+    n, s, s2 = 0, 0, 0
+    with ThreadPoolExecutor(n_workers) as executor:
+        for n_, s_, s2_ in executor.map(_tile_sums, image_paths):
+            n, s, s2 = n + n_, s + s_, s2 + s2_
+
+    means = s / n
+    stds = np.sqrt(np.maximum(s2 / n - means ** 2, 0))
 
     with open(outpath, "w+") as f:
         stats = {"means": means.tolist(), "stds": stds.tolist()}
@@ -143,6 +183,26 @@ def generate_stats(image_paths, sample_size, outpath="stats.json"):
     return stats
 
 
+def _stats_arrays(means, stds):
+    """Shape means and inverse stds for broadcasting against HWC images"""
+    stds = np.asarray(stds, dtype=np.float32)
+    zero_std = ~(stds > 0)
+    inv_std = np.where(zero_std, 0, 1 / np.where(zero_std, 1, stds))
+    return (
+        np.asarray(means, dtype=np.float32).reshape(1, 1, -1),
+        inv_std.astype(np.float32).reshape(1, 1, -1),
+        zero_std,
+    )
+
+
+def _normalize(img, means, inv_std, zero_std):
+    """In place normalization with arrays from _stats_arrays"""
+    np.subtract(img, means, out=img)
+    np.multiply(img, inv_std, out=img)
+    img[:, :, zero_std] = 0
+    return img
+
+
 def normalize_(img, means, stds):
     """
     Args:
@@ -153,14 +213,15 @@ def normalize_(img, means, stds):
     Return:
         img: Normalized img
     """
-    for i in range(img.shape[2]):
-        img[:, :, i] -= means[i]
-        if stds[i] > 0:
-            img[:, :, i] /= stds[i]
-        else:
-            img[:, :, i] = 0
+    return _normalize(img, *_stats_arrays(means, stds))
 
-    return img
+
+@functools.lru_cache(maxsize=8)
+def _load_stats(stats_path, mtime):
+    """Parse a statistics json once per (path, modification time)"""
+    with open(stats_path, "r") as f:
+        stats = json.load(f)
+    return _stats_arrays(stats["means"], stats["stds"])
 
 
 def normalize(img, mask, stats_path):
@@ -174,8 +235,36 @@ def normalize(img, mask, stats_path):
     Return:
         Normalized image and corresponding mask
     """
-    stats = json.load(open(stats_path, "r"))
-    img = normalize_(img, stats["means"], stats["stds"])
+    stats = _load_stats(stats_path, os.path.getmtime(stats_path))
+    img = _normalize(img, *stats)
+    return img, mask
+
+
+def impute_normalize(img, mask, stats_path, value=0, block_rows=16):
+    """impute followed by normalize, fused into one pass
+
+    The image is processed in blocks of rows small enough to stay in cache, so
+    that each block is read from memory once for all the operations.
+
+    Args:
+        img: image to impute and normalize
+        mask: mask
+        stats_path: path to dataset statistics
+        value: imputation value
+        block_rows: number of image rows processed at a time
+
+    Return:
+        Imputed and normalized image and corresponding mask
+    """
+    means, inv_std, zero_std = _load_stats(stats_path, os.path.getmtime(stats_path))
+
+    for i in range(0, img.shape[0], block_rows):
+        block = img[i:(i + block_rows)]
+        np.nan_to_num(block, copy=False, nan=value)
+        np.subtract(block, means, out=block)
+        np.multiply(block, inv_std, out=block)
+
+    img[:, :, zero_std] = 0
     return img, mask
 
 
@@ -190,7 +279,7 @@ def impute(img, mask, value=0):
     Return:
         image and corresponding mask after imputation
     """
-    img = np.nan_to_num(img, nan=value)
+    img = np.nan_to_num(img, copy=False, nan=value)
     return img, mask
 
 
@@ -227,20 +316,67 @@ def add_bg_channel(img, mask):
     mask = np.dstack((mask, bg_mask))
     return img, mask
 
+def cast(img, mask, dtype="float16"):
+    """Change the storage type of the image and mask
+
+    Args:
+        img: Image to cast
+        mask: Mask to cast
+        dtype: Target numpy dtype. Normalized channels fit comfortably in float16.
+
+    Return:
+        Image and corresponding mask with the new dtype"""
+    return img.astype(dtype, copy=False), mask.astype(dtype, copy=False)
+
+def compile_pipeline(process_funs):
+    """Bind a list of processing functions once
+
+    Args:
+        process_funs: Specified process functions, mapping function names to
+          their keyword arguments
+
+    Return:
+        A function taking an image and mask and applying each process function
+        in turn
+    """
+    steps = [(fun_name, dict(fun_args)) for fun_name, fun_args in process_funs.items()]
+
+    # impute directly followed by normalize can be done in a single pass
+    for i in range(len(steps) - 1):
+        if steps[i][0] == "impute" and steps[i + 1][0] == "normalize":
+            steps[i:(i + 2)] = [("impute_normalize", {**steps[i][1], **steps[i + 1][1]})]
+            break
+
+    chain = [
+        functools.partial(getattr(sys.modules[__name__], fun_name), **fun_args)
+        for fun_name, fun_args in steps
+    ]
+
+    def run(img, mask):
+        for f in chain:
+            img, mask = f(img, mask)
+        return img, mask
+
+    return run
+
+
 def postprocess_tile(img, process_funs):
     """Apply a list of processing functions
 
     Args:
-        img: Image to postprocess
-        process_funs: Specified process functions
+        img: Image to postprocess. It is copied before processing, since the
+          processing functions may work in place.
+        process_funs: Specified process functions, or a pipeline from
+          compile_pipeline built with extract_channel.mask_channels = 0
 
     Return:
         Image, mask and specified process functions
     """
     # create fake mask input
-    process_funs.extract_channel.mask_channels = 0
+    if not callable(process_funs):
+        process_funs.extract_channel.mask_channels = 0
     mask = np.zeros((img.shape[0], img.shape[1], 1))
-    return postprocess_(img, mask, process_funs)
+    return postprocess_(np.array(img), mask, process_funs)
 
 
 def postprocess_(img, mask, process_funs):
@@ -249,16 +385,16 @@ def postprocess_(img, mask, process_funs):
     Args:
         img: Image to postprocess
         mask: Mask to postprocess
-        process_funs: Specified post process functions
+        process_funs: Specified post process functions, or a pipeline from
+          compile_pipeline
 
     Return:
         Post processed images and masks
     """
-    for fun_name, fun_args in process_funs.items():
-        f = getattr(sys.modules[__name__], fun_name)
-        img, mask = f(img, mask, **fun_args)
+    if not callable(process_funs):
+        process_funs = compile_pipeline(process_funs)
 
-    return img, mask
+    return process_funs(img, mask)
 
 
 def postprocess(img_path, mask_path, process_funs):
@@ -267,7 +403,8 @@ def postprocess(img_path, mask_path, process_funs):
     Args:
         img_path(str): Path to single image
         mask_path(str): Path to single mask
-        process_funs: Specified process functions
+        process_funs: Specified process functions, or a pipeline from
+          compile_pipeline
 
     Return:
         Postprocess image, mask and postprocess function
@@ -17,7 +17,7 @@ from shapely.ops import unary_union
 import skimage.measure
 from skimage.util.shape import view_as_windows
 from rasterio.windows import Window
-from .data.process_slices_funs import postprocess_tile
+from .data.process_slices_funs import compile_pipeline, postprocess_tile
 from .models.frame import Framework
 
 
@@ -101,6 +101,8 @@ def inference(img, model, process_conf, overlap=0, infer_size=1024, device=None)
     """
     process_opts = Dict(yaml.safe_load(open(process_conf, "r")))
     channels = process_opts.process_funs.extract_channel.img_channels
+    process_opts.process_funs.extract_channel.mask_channels = 0
+    pipeline = compile_pipeline(process_opts.process_funs)
     if device is None:
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -116,20 +118,21 @@ def inference(img, model, process_conf, overlap=0, infer_size=1024, device=None)
     slice_imgs = view_as_windows(img, slice_size, step=slice_size[0] - overlap)
 
     I, J, _, _, _, _ = slice_imgs.shape
-    predictions = np.zeros((I, J, 1, slice_size[0], slice_size[1], 1))
-    patches = np.zeros((I, J, 1, slice_size[0], slice_size[1], len(channels)))
+    predictions = np.zeros((I, J, 1, slice_size[0], slice_size[1], 1), dtype=np.float32)
+    patches = np.zeros((I, J, 1, slice_size[0], slice_size[1], len(channels)), dtype=np.float32)
 
     for i in range(I):
         for j in range(J):
-            patch, _ = postprocess_tile(slice_imgs[i, j, 0], process_opts.process_funs)
+            patch, _ = postprocess_tile(slice_imgs[i, j, 0], pipeline)
             patches[i, j, :] = patch
-            patch = np.transpose(patch, (2, 0, 1))
-            patch = torch.from_numpy(patch).float().unsqueeze(0)
+
+            # single contiguous float32 copy in channel-first layout
+            patch = np.ascontiguousarray(patches[i, j, 0].transpose(2, 0, 1))
+            patch = torch.from_numpy(patch).unsqueeze(0)
 
             with torch.no_grad():
                 patch = patch.to(device)
-                y_hat = model(patch).cpu().numpy()
-                y_hat = 1 / (1 + np.exp(-y_hat))
+                y_hat = torch.sigmoid(model(patch)).cpu().numpy()
                 predictions[i, j, 0] = np.transpose(y_hat, (0, 2, 3, 1))
 
     x = merge_patches(patches, overlap)
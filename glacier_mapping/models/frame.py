@@ -23,7 +23,7 @@ class Framework:
     """
 
     def __init__(self, loss_fn=None, model_opts=None, optimizer_opts=None,
-                 reg_opts=None, device=None):
+                 reg_opts=None, aug_opts=None, device=None):
         """
         Set Class Attrributes
         """
@@ -51,6 +51,7 @@ class Framework:
                                              verbose=True, patience=10,
                                              min_lr=1e-6)
         self.reg_opts = reg_opts
+        self.aug_opts = aug_opts
 
 
     def optimize(self, x, y):
@@ -63,8 +64,8 @@ class Framework:
         Return:
             optimization
         """
-        x = x.permute(0, 3, 1, 2).to(self.device)
-        y = y.permute(0, 3, 1, 2).to(self.device)
+        x = x.permute(0, 3, 1, 2).to(self.device, non_blocking=True)
+        y = y.permute(0, 3, 1, 2).to(self.device, non_blocking=True)
 
         self.optimizer.zero_grad()
         y_hat = self.model(x)
@@ -73,6 +74,43 @@ class Framework:
         self.optimizer.step()
         return y_hat.permute(0, 2, 3, 1), loss.item()
 
+    def augment(self, x, y):
+        """
+        Randomly flip and rotate a batch on the device
+
+        Each sample is transformed independently, and the same transformation
+        is applied to its mask. aug_opts gives the probability of each of
+        hflip, vflip and rot90 (90 degree rotation, square tiles only). Returns
+        the batch unchanged if these are all zero or missing.
+
+        Args:
+            x: channel last batch of images
+            y: channel last batch of labels
+        Return:
+            augmented x and y, on the device
+        """
+        x = x.to(self.device, non_blocking=True)
+        y = y.to(self.device, non_blocking=True)
+        if not self.aug_opts:
+            return x, y
+
+        if self.aug_opts.get("rot90", 0) > 0 and x.shape[1] != x.shape[2]:
+            raise ValueError(f"rot90 augmentation requires square tiles, got {tuple(x.shape[1:3])}")
+
+        transforms = [
+            (self.aug_opts.get("hflip", 0), lambda z: z.flip(2)),
+            (self.aug_opts.get("vflip", 0), lambda z: z.flip(1)),
+            (self.aug_opts.get("rot90", 0), lambda z: z.rot90(1, (1, 2)))
+        ]
+
+        for p, transform in transforms:
+            if p > 0:
+                apply = torch.rand(x.shape[0], 1, 1, 1, device=x.device) < p
+                x = torch.where(apply, transform(x), x)
+                y = torch.where(apply, transform(y), y)
+
+        return x, y
+
     def val_operations(self, val_loss):
         """
         Update the LR Scheduler
@@ -101,7 +139,7 @@ class Framework:
             Prediction
 
         """
-        x = x.permute(0, 3, 1, 2).to(self.device)
+        x = x.permute(0, 3, 1, 2).to(self.device, non_blocking=True)
         with torch.no_grad():
             return self.model(x).permute(0, 2, 3, 1)
 
@@ -19,6 +19,7 @@ import numpy as np
 import pandas as pd
 from torchvision.utils import make_grid
 import torch
+from .data.data import CUDAPrefetcher
 
 
 def train_epoch(loader, frame, metrics_opts):
@@ -41,7 +42,8 @@ def train_epoch(loader, frame, metrics_opts):
     """
     loss, metrics = 0, {}
     frame.model.train()
-    for x, y in loader:
+    for x, y in prefetch(loader, frame.device):
+        x, y = frame.augment(x, y)
         y_hat, _loss = frame.optimize(x, y)
         loss += _loss
 
@@ -55,6 +57,20 @@ def train_epoch(loader, frame, metrics_opts):
     return loss / len(loader.dataset), metrics
 
 
+def prefetch(loader, device):
+    """Overlap host to device copies with compute when training on a GPU
+
+    :param loader: A DataLoader containing x,y pairs.
+    :type loader: torch.utils.data.DataLoader
+    :param device: The device the model lives on.
+    :type device: torch.device
+    :return: An iterable over the (x, y) pairs of loader.
+    """
+    if device.type == "cuda":
+        return CUDAPrefetcher(loader, device)
+    return loader
+
+
 def validate(loader, frame, metrics_opts):
     """Compute Metrics on a Validation Loader
 
@@ -77,7 +93,7 @@ def validate(loader, frame, metrics_opts):
     loss, metrics = 0, {}
     channel_first = lambda x: x.permute(0, 3, 1, 2)
     frame.model.eval()
-    for x, y in loader:
+    for x, y in prefetch(loader, frame.device):
         with torch.no_grad():
             y_hat = frame.infer(x)
             loss += frame.calc_loss(channel_first(y_hat), channel_first(y)).item()
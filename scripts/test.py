@@ -67,7 +67,7 @@ if __name__ == "__main__":
         inp_np = np.load(s)
         start = time.time()
         nan_mask = np.isnan(inp_np[:,:,:9]).any(axis=2)
-        inp_tensor = torch.from_numpy(np.expand_dims(np.transpose(inp_np, (2,0,1)), axis=0))
+        inp_tensor = torch.from_numpy(np.expand_dims(np.transpose(inp_np, (2,0,1)), axis=0)).float()
         inp_tensor = inp_tensor.to(device)
         output = unet(inp_tensor)
         output_np = output.detach().cpu().numpy()
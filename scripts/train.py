@@ -47,7 +47,7 @@ if __name__ == '__main__':
     # TODO:handle this error better
     # if input mask dimension different than outchannels
     outchannels = conf.model_opts.args.outchannels
-    y_channels = [y.shape[-1] for _, y in loaders["val"]][0]
+    y_channels = loaders["val"].dataset[0][1].shape[-1]
     if y_channels != outchannels:
         raise ValueError("Output dimension is different from model outchannels.")
 
@@ -67,6 +67,7 @@ if __name__ == '__main__':
         model_opts=conf.model_opts,
         optimizer_opts=conf.optim_opts,
         reg_opts=conf.reg_opts,
+        aug_opts=conf.aug_opts,
         loss_fn=loss_fn,
         device=device
     )
@@ -0,0 +1,22 @@
+import json
+import numpy as np
+import pytest
+
+pf = pytest.importorskip("glacier_mapping.data.process_slices_funs")
+
+
+def test_impute_normalize_matches_impute_then_normalize(tmp_path):
+    stats_path = tmp_path / "stats.json"
+    with open(stats_path, "w") as f:
+        json.dump({"means": [0.1, 0.2, 0.3], "stds": [0.5, 0, 1]}, f)
+
+    img = np.random.rand(40, 8, 3).astype(np.float32)
+    img[0, 0, 0] = np.nan
+    img[17, 2, 2] = np.inf
+    img[33, 5, 2] = -np.inf
+    img[20, 1, 1] = np.nan
+
+    expected, _ = pf.normalize(*pf.impute(img.copy(), None, value=2), stats_path)
+    result, _ = pf.impute_normalize(img.copy(), None, stats_path, value=2)
+    np.testing.assert_array_equal(result, expected)
+    assert np.all(result[:, :, 1] == 0)